@@ -179,7 +179,8 @@ parser.add_argument(
     "--loss_reduction",
     default='mean',
     type=str,
-    help="specifies the reduction to apply to the final loss, choose 'mean' or 'sum'",
+    choices=['mean', 'sum', 'global_mean'],
+    help="specifies the reduction to apply to the final loss, choose 'mean', 'sum' or 'global_mean'",
 )
 
 parser.add_argument(
@@ -349,7 +350,7 @@ def create_pipeline(dataset_split='train'):
     )
 
     if dataset_split == 'train':
-        loss = dst_loss(
+        dst_loss_output = dst_loss(
             logit_intent_status=logit_intent_status,
             intent_status_labels=data.intent_status_labels,
             logit_req_slot_status=logit_req_slot_status,
@@ -368,7 +369,7 @@ def create_pipeline(dataset_split='train'):
             noncategorical_slot_value_start=data.noncategorical_slot_value_start,
             noncategorical_slot_value_end=data.noncategorical_slot_value_end,
         )
-        tensors = [loss]
+        tensors = [dst_loss_output.loss]
     else:
         tensors = [
             data.example_id_num,
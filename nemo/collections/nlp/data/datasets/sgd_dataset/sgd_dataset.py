@@ -61,7 +61,7 @@ class SGDDataset(Dataset):
             np.array(ex.end_char_idx),  # noncat_alignment_end
             np.array(ex.num_slots),  # num_requested_slots
             np.array(ex.requested_slot_status, dtype=np.float32),
-            np.array(ex.requested_slot_mask),
+            np.array(ex.requested_slot_mask, dtype=bool),
             np.array(ex.intent_status_mask),
             np.array(ex.intent_status_labels),
         )
@@ -57,8 +57,8 @@ class SGDDataLayer(DataLayerNM):
         start_char_idx (int): Start character indices in the original utterance corresponding to the tokens
         end_char_idx (int): Inclusive end character indices in the original utterance corresponding to the tokens
         num_slots (int): Total number of slots present in the service
-        requested_slot_status (int): Takes value 1 if the corresponding slot is requested, 0 otherwise
-        req_slot_mask (int): Masks requested slots not used for the particular service
+        requested_slot_status (float): Takes value 1 if the corresponding slot is requested, 0 otherwise
+        req_slot_mask (bool): Masks requested slots not used for the particular service
         intent_status_mask (long): Masks out padded intents in the service, takes values 0 and 1
         intent_status_labels (int): Intent labels
 
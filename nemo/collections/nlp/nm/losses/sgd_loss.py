@@ -21,6 +21,7 @@ https://github.com/google-research/google-research/blob/master/schema_guided_dst
 '''
 
 import torch
+import torch.nn.functional as F
 
 from nemo import logging
 from nemo.backends.pytorch import LossNM
@@ -84,23 +85,71 @@ class SGDDialogueStateLossNM(LossNM):
         Returns definitions of module output ports.
         loss:
             NeuralType(None)
+        intent_loss, requested_slot_loss, cat_slot_status_loss, cat_slot_value_loss, noncat_slot_status_loss,
+        span_start_loss, span_end_loss:
+            NeuralType(None), detached per-task losses for logging. What each holds depends on the reduction:
+                'mean': the task loss averaged over its active elements, loss is the mean of the seven ports.
+                'sum': the task loss summed over its active elements (not divided by the batch size),
+                    loss is the sum of the seven ports divided by the batch size.
+                'global_mean': the task loss summed over its active elements,
+                    loss is the sum of the seven ports divided by the number of active elements across all tasks.
+            They stay on the device, so avoid calling .item() on them every step, fetch them only at the logging
+            frequency.
         """
-        return {"loss": NeuralType(None)}
+        return {
+            "loss": NeuralType(None),
+            "intent_loss": NeuralType(None),
+            "requested_slot_loss": NeuralType(None),
+            "cat_slot_status_loss": NeuralType(None),
+            "cat_slot_value_loss": NeuralType(None),
+            "noncat_slot_status_loss": NeuralType(None),
+            "span_start_loss": NeuralType(None),
+            "span_end_loss": NeuralType(None),
+        }
 
     def __init__(self, reduction='mean'):
         """
         Args:
-            reduction (str): specifies the reduction to apply to the final loss, choose 'mean' or 'sum'
+            reduction (str): specifies the reduction to apply to the final loss, choose 'mean', 'sum' or
+                'global_mean'. 'mean' averages each task loss over its own active elements and then averages the
+                tasks, 'sum' sums every task loss and divides by the batch size. 'global_mean' sums every task loss
+                and divides once by the total number of active elements across all tasks, so each intent, slot and
+                span is weighted equally regardless of the task it belongs to.
         """
         super().__init__()
 
-        if reduction not in ['mean', 'sum']:
+        if reduction not in ['mean', 'sum', 'global_mean']:
             logging.warning(f'{reduction} reduction is not supported. Setting reduction to "mean"')
             reduction = 'mean'
 
         self.reduction = reduction
-        self._cross_entropy = torch.nn.CrossEntropyLoss(reduction=self.reduction)
-        self._criterion_req_slots = torch.nn.BCEWithLogitsLoss(reduction=self.reduction)
+        # 'global_mean' accumulates per-task sums and normalizes once in _loss_function
+        self._task_reduction = 'sum' if reduction == 'global_mean' else reduction
+
+    def _zero_loss(self, logits):
+        """
+        Placeholder loss for a task without active slots in the batch.
+        If the logits require grad, the zero stays attached to the graph while reading a single row, so that every
+        parameter still receives a gradient. Otherwise a plain zero scalar is returned without reading the logits.
+        Args:
+            logits (float): flattened logits of the task, shape (batch_size * max_num_slots, num_classes)
+        """
+        if logits.requires_grad:
+            return logits[:1].sum() * 0.0
+        return torch.zeros((), device=logits.device, dtype=logits.dtype)
+
+    def _active_cross_entropy(self, active_logits, active_labels):
+        """
+        Cross entropy over rows that were already selected by a slot mask.
+        The rows are summed and, for 'mean' reduction, divided by their count, so no ignore_index filtering is done.
+        Args:
+            active_logits (float): logits of the active rows, shape (num_active, num_classes)
+            active_labels (int): labels of the active rows, shape (num_active)
+        """
+        loss = F.cross_entropy(active_logits, active_labels, reduction='sum')
+        if self.reduction == 'mean':
+            loss = loss / max(active_logits.size(0), 1)
+        return loss
 
     def _loss_function(
         self,
@@ -122,106 +171,140 @@ class SGDDialogueStateLossNM(LossNM):
         noncategorical_slot_value_start,
         noncategorical_slot_value_end,
     ):
+        # bind the helpers used by several tasks once instead of looking them up on self for every task
+        active_cross_entropy = self._active_cross_entropy
+        zero_loss = self._zero_loss
+
         # Intent loss
-        intent_loss = self._cross_entropy(logit_intent_status, intent_status_labels)
+        intent_loss = F.cross_entropy(logit_intent_status, intent_status_labels, reduction=self._task_reduction)
 
         # Requested slots.
         # Shape: (batch_size, max_num_slots)
         # mask unused slots
         # Sigmoid cross entropy is used because more than one slots can be requested in a single utterance
-        requested_slot_loss = self._criterion_req_slots(
-            logit_req_slot_status.view(-1)[req_slot_mask], requested_slot_status.view(-1)[req_slot_mask]
+        # the data layer already emits float32 targets, so this cast is a no-op unless the logits are half precision
+        requested_slot_status = requested_slot_status.to(logit_req_slot_status.dtype)
+        req_slot_mask = req_slot_mask.bool()
+        requested_slot_active_logits = torch.masked_select(logit_req_slot_status, req_slot_mask)
+        requested_slot_loss = F.binary_cross_entropy_with_logits(
+            requested_slot_active_logits,
+            torch.masked_select(requested_slot_status, req_slot_mask),
+            reduction=self._task_reduction,
         )
 
-        # Categorical slot status
+        # Flatten the slot logits and labels once, the (batch_size * max_num_slots, num_classes) logit views and the
+        # (batch_size * max_num_slots) label views are shared by the active and the fallback branches below.
+        # The label tensors are stacked by the default collate and are always contiguous, so they are flattened with
+        # view. The span logits are strided views from torch.unbind in SGDDecoderNM. reshape returns a view for them
+        # as well, because only the leading dims are merged, so no copy is made and no contiguous() is needed upstream.
+        max_num_slot_values = logit_cat_slot_value.size()[-1]
+        max_num_tokens = logit_noncat_slot_start.size()[-1]
+        logit_cat_slot_status = logit_cat_slot_status.reshape(-1, 3)
+        logit_cat_slot_value = logit_cat_slot_value.reshape(-1, max_num_slot_values)
+        logit_noncat_slot_status = logit_noncat_slot_status.reshape(-1, 3)
+        logit_noncat_slot_start = logit_noncat_slot_start.reshape(-1, max_num_tokens)
+        logit_noncat_slot_end = logit_noncat_slot_end.reshape(-1, max_num_tokens)
+        categorical_slot_status = categorical_slot_status.view(-1)
+        categorical_slot_values = categorical_slot_values.view(-1)
+        noncategorical_slot_status = noncategorical_slot_status.view(-1)
+        noncategorical_slot_value_start = noncategorical_slot_value_start.view(-1)
+        noncategorical_slot_value_end = noncategorical_slot_value_end.view(-1)
+
+        # Categorical and non-categorical slot status.
         # Shape of logit_cat_slot_status: (batch_size, max_num_cat_slots, 3)
+        # Shape of logit_noncat_slot_status: (batch_size, max_num_noncat_slots, 3).
+        # Both share the same 3 status classes, so the active slots of the two groups are scored with a single
+        # cross entropy call and split back to keep a separate loss per group.
         cat_slot_status_mask = cat_slot_status_mask.view(-1) > 0.5
-        if sum(cat_slot_status_mask) == 0:
+        noncat_slot_status_mask = noncat_slot_status_mask.view(-1) > 0.5
+        cat_slot_status_active_logits = logit_cat_slot_status[cat_slot_status_mask]
+        noncat_slot_status_active_logits = logit_noncat_slot_status[noncat_slot_status_mask]
+        slot_status_losses = F.cross_entropy(
+            torch.cat([cat_slot_status_active_logits, noncat_slot_status_active_logits]),
+            torch.cat(
+                [categorical_slot_status[cat_slot_status_mask], noncategorical_slot_status[noncat_slot_status_mask]]
+            ),
+            reduction='none',
+        )
+        # Boolean indexing already synchronizes to size its output, so the number of active rows is known on the host
+        # and the empty-batch checks below need no extra reduction on the device.
+        num_active_cat_slots = cat_slot_status_active_logits.size(0)
+        num_active_noncat_slots = noncat_slot_status_active_logits.size(0)
+        cat_slot_status_losses, noncat_slot_status_losses = slot_status_losses.split(
+            [num_active_cat_slots, num_active_noncat_slots]
+        )
+        reduce = torch.mean if self.reduction == 'mean' else torch.sum
+
+        if num_active_cat_slots == 0:
             logging.warning(f'No active categorical slots in the batch')
-            cat_slot_status_loss = self._cross_entropy(
-                logit_cat_slot_status.view(-1, 3), torch.argmax(logit_cat_slot_status.view(-1, 3), dim=-1)
-            )
+            cat_slot_status_loss = zero_loss(logit_cat_slot_status)
+        else:
+            cat_slot_status_loss = reduce(cat_slot_status_losses)
+
+        if num_active_noncat_slots == 0:
+            logging.warning(f'No active non-categorical slots in the batch.')
+            noncat_slot_status_loss = zero_loss(logit_noncat_slot_status)
         else:
-            cat_slot_status_loss = self._cross_entropy(
-                logit_cat_slot_status.view(-1, 3)[cat_slot_status_mask],
-                categorical_slot_status.view(-1)[cat_slot_status_mask],
-            )
+            noncat_slot_status_loss = reduce(noncat_slot_status_losses)
 
         # Categorical slot values.
         # Shape: (batch_size, max_num_cat_slots, max_num_slot_values).
-        max_num_slot_values = logit_cat_slot_value.size()[-1]
-
         # Zero out losses for categorical slot value when the slot status is not active.
-        cat_slot_value_mask = (categorical_slot_status == STATUS_ACTIVE).view(-1)
-        # to handle cases with no active categorical slot value
-        cat_slot_value_mask = cat_slot_value_mask.view(-1) > 0.5
-        if sum(cat_slot_value_mask) == 0:
+        cat_slot_value_mask = categorical_slot_status == STATUS_ACTIVE
+        slot_values_active_logits = logit_cat_slot_value[cat_slot_value_mask]
+        num_active_slot_values = slot_values_active_logits.size(0)
+        if num_active_slot_values == 0:
             logging.warning(f'No active values for categorical slots in the batch.')
-            cat_slot_value_loss = self._cross_entropy(
-                logit_cat_slot_value.view(-1, max_num_slot_values),
-                torch.argmax(logit_cat_slot_value.view(-1, max_num_slot_values), dim=-1),
-            )
+            cat_slot_value_loss = zero_loss(logit_cat_slot_value)
         else:
-            slot_values_active_logits = logit_cat_slot_value.view(-1, max_num_slot_values)[cat_slot_value_mask]
-            slot_values_active_labels = categorical_slot_values.view(-1)[cat_slot_value_mask]
-            cat_slot_value_loss = self._cross_entropy(slot_values_active_logits, slot_values_active_labels)
-
-        # Non-categorical slot status.
-        # Shape: (batch_size, max_num_noncat_slots, 3).
-        noncat_slot_status_mask = noncat_slot_status_mask.view(-1) > 0.5
-        if sum(noncat_slot_status_mask) == 0:
-            logging.warning(f'No active non-categorical slots in the batch.')
-            noncat_slot_status_loss = self._cross_entropy(
-                logit_noncat_slot_status.view(-1, 3), torch.argmax(logit_noncat_slot_status.view(-1, 3), dim=-1)
-            )
-        else:
-            noncat_slot_status_loss = self._cross_entropy(
-                logit_noncat_slot_status.view(-1, 3)[noncat_slot_status_mask],
-                noncategorical_slot_status.view(-1)[noncat_slot_status_mask],
-            )
+            slot_values_active_labels = categorical_slot_values[cat_slot_value_mask]
+            cat_slot_value_loss = active_cross_entropy(slot_values_active_logits, slot_values_active_labels)
 
         # Non-categorical slot spans.
         # Shape: (batch_size, max_num_noncat_slots, max_num_tokens).n
-        max_num_tokens = logit_noncat_slot_start.size()[-1]
         # Zero out losses for non-categorical slot spans when the slot status is not active.
         # changed here
-        non_cat_slot_value_mask = (noncategorical_slot_status == STATUS_ACTIVE).view(-1)
-        # non_cat_slot_value_mask = (noncategorical_slot_status > -1 ).view(-1)
-        # to handle cases with no active categorical slot value
-        non_cat_slot_value_mask = non_cat_slot_value_mask.view(-1)
-        if sum(non_cat_slot_value_mask) == 0:
+        non_cat_slot_value_mask = noncategorical_slot_status == STATUS_ACTIVE
+        noncat_slot_start_active_logits = logit_noncat_slot_start[non_cat_slot_value_mask]
+        num_active_spans = noncat_slot_start_active_logits.size(0)
+        if num_active_spans == 0:
             logging.warning(f'No active values for non-categorical slots in the batch.')
-            span_start_loss = self._cross_entropy(
-                logit_noncat_slot_start.view(-1, max_num_tokens),
-                torch.argmax(logit_noncat_slot_start.view(-1, max_num_tokens), dim=-1),
-            )
-            span_end_loss = self._cross_entropy(
-                logit_noncat_slot_end.view(-1, max_num_tokens),
-                torch.argmax(logit_noncat_slot_end.view(-1, max_num_tokens), dim=-1),
-            )
+            span_start_loss = zero_loss(logit_noncat_slot_start)
+            span_end_loss = zero_loss(logit_noncat_slot_end)
         else:
-            noncat_slot_start_active_logits = logit_noncat_slot_start.view(-1, max_num_tokens)[non_cat_slot_value_mask]
-            noncat_slot_start_active_labels = noncategorical_slot_value_start.view(-1)[non_cat_slot_value_mask]
-            span_start_loss = self._cross_entropy(noncat_slot_start_active_logits, noncat_slot_start_active_labels)
-
-            noncat_slot_end_active_logits = logit_noncat_slot_end.view(-1, max_num_tokens)[non_cat_slot_value_mask]
-            noncat_slot_end_active_labels = noncategorical_slot_value_end.view(-1)[non_cat_slot_value_mask]
-            span_end_loss = self._cross_entropy(noncat_slot_end_active_logits, noncat_slot_end_active_labels)
-
-        losses = {
-            "intent_loss": intent_loss,
-            "requested_slot_loss": requested_slot_loss,
-            "cat_slot_status_loss": cat_slot_status_loss,
-            "cat_slot_value_loss": cat_slot_value_loss,
-            "noncat_slot_status_loss": noncat_slot_status_loss,
-            "span_start_loss": span_start_loss,
-            "span_end_loss": span_end_loss,
-        }
+            noncat_slot_start_active_labels = noncategorical_slot_value_start[non_cat_slot_value_mask]
+            span_start_loss = active_cross_entropy(noncat_slot_start_active_logits, noncat_slot_start_active_labels)
+
+            noncat_slot_end_active_logits = logit_noncat_slot_end[non_cat_slot_value_mask]
+            noncat_slot_end_active_labels = noncategorical_slot_value_end[non_cat_slot_value_mask]
+            span_end_loss = active_cross_entropy(noncat_slot_end_active_logits, noncat_slot_end_active_labels)
+
+        # same order as the per-task output ports
+        losses = (
+            intent_loss,
+            requested_slot_loss,
+            cat_slot_status_loss,
+            cat_slot_value_loss,
+            noncat_slot_status_loss,
+            span_start_loss,
+            span_end_loss,
+        )
+        num_active_elements = (
+            logit_intent_status.size(0)
+            + requested_slot_active_logits.size(0)
+            + num_active_cat_slots
+            + num_active_noncat_slots
+            + num_active_slot_values
+            + 2 * num_active_spans
+        )
 
-        total_loss = sum(losses.values())
+        loss_vec = torch.stack(losses)
         if self.reduction == 'mean':
-            total_loss = total_loss / len(losses)
+            total_loss = loss_vec.mean()
+        elif self.reduction == 'global_mean':
+            total_loss = loss_vec.sum() / max(num_active_elements, 1)
         else:
             batch_size = logit_intent_status.shape[0]
-            total_loss = total_loss / batch_size
-        return total_loss
+            total_loss = loss_vec.sum() / batch_size
+        # the per-task losses follow the order of the output ports
+        return (total_loss, *loss_vec.detach().unbind())